@@ -2,18 +2,58 @@
 
 import logging
 import json
+import socket
+import threading
 from typing import Callable
 
 import paho.mqtt.client as mqtt
 
 import config
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+# Payloads published to K1..K4 to switch the outputs off and on
+_OFF = b"0"
+_ON = b"1"
+
+# Send/receive buffer size for the MQTT socket
+SOCKET_BUFFER_SIZE = 1 << 20
+
+# Integer lookup tables between device channel levels (0..1000) and RGBW values (0..255)
+_CH_TO_RGB = tuple((v * 255 + 500) // 1000 for v in range(1001))
+_RGB_TO_CH = tuple((v * 1000 + 127) // 255 for v in range(256))
+
 
 class Device:
+    __slots__ = (
+        "client",
+        "name",
+        "_update_callbacks",
+        "_pending_lock",
+        "_pending_publish",
+        "_flush_lock",
+    )
+
+    # Delay in seconds used to coalesce bursts of updates into one callback run
+    UPDATE_DELAY = 0.02
+
     def __init__(self, client: mqtt.Client, name: str) -> None:
         self.client = client
         self.name = name
         self._update_callbacks: list[Callable] = []
+        self._pending_lock = threading.Lock()
+        self._pending_publish = False
+        # Serializes flushes so an older one cannot finish after a newer one
+        self._flush_lock = threading.Lock()
 
     def add_update_callback(self, callback: Callable) -> None:
         """Add a callback to be executed when the device state updates."""
@@ -24,11 +64,31 @@ class Device:
         self._update_callbacks.remove(callback)
 
     def _execute_callbacks(self) -> None:
-        """Execute all registered update callbacks."""
-        for fn in self._update_callbacks:
-            fn(self)
+        """Schedule registered update callbacks, coalescing bursts of updates."""
+        with self._pending_lock:
+            if self._pending_publish:
+                return
+            self._pending_publish = True
 
-    def process_message(self, topic: str, payload: str) -> None:
+        timer = threading.Timer(self.UPDATE_DELAY, self._flush)
+        timer.daemon = True
+        timer.start()
+
+    def _flush(self) -> None:
+        """Execute all registered update callbacks."""
+        with self._flush_lock:
+            # Cleared while holding the flush lock, so a flush scheduled from here on
+            # waits for this one and then sees at least the state read below
+            with self._pending_lock:
+                self._pending_publish = False
+
+            for fn in self._update_callbacks:
+                try:
+                    fn(self)
+                except Exception as e:
+                    logging.exception(f"Error executing update callback for {self.name}: {e}")
+
+    def process_message(self, topic: str, payload: bytes) -> None:
         """Process incoming MQTT message."""
         pass
 
@@ -36,40 +96,79 @@ class Device:
 class RazumdomRGBW(Device):
     """Represents a Razumdom RGBW device controlled via MQTT."""
 
+    __slots__ = (
+        "channels",
+        "_k",
+        "_k_on_count",
+        "_ch_rgb",
+        "_k_on_topics",
+        "_channel_on_topics",
+        "_rgbw_order",
+        "_ctrl_prefix_len",
+        "_dispatch",
+    )
+
     def __init__(self, client: mqtt.Client, name: str, channels: dict[str, int], **kwargs) -> None:
         super().__init__(client, name)
         self.channels = channels  # Custom channel mappings
 
-        self.state = {
-            "k_values": {f"K{i}": 0 for i in range(1, 5)},
-            "channel_values": {f"Channel {i}": 0 for i in range(1, 5)},
+        # K1..K4 on flags (1 if value > 0) and Channel 1..4 levels scaled to 0..255,
+        # indexed by number - 1
+        self._k = [0, 0, 0, 0]
+        self._k_on_count = 0
+        self._ch_rgb = [0, 0, 0, 0]
+
+        # Precomputed publish topics and channel numbers in R, G, B, W order
+        # (None if not configured)
+        self._rgbw_order = [self._channel_number(color) for color in ("R", "G", "B", "W")]
+        self._k_on_topics = [f"/devices/{self.name}/controls/K{i}/on" for i in range(1, 5)]
+        self._channel_on_topics = {
+            c: f"/devices/{self.name}/controls/Channel {c}/on"
+            for c in self._rgbw_order
+            if c is not None
+        }
+        self._ctrl_prefix_len = len(f"/devices/{self.name}/controls/")
+        # Control name -> (target list, index into it)
+        self._dispatch = {f"K{i}": (self._k, i - 1) for i in range(1, 5)} | {
+            f"Channel {i}": (self._ch_rgb, i - 1) for i in range(1, 5)
         }
 
         # Subscribe to device-specific topics
-        for i in range(1, 5):
-            self.client.message_callback_add(
-                f"/devices/{self.name}/controls/Channel {i}",
-                lambda c, u, m: self.process_message(m.topic, m.payload.decode("utf-8")),
-            )
-            self.client.message_callback_add(
-                f"/devices/{self.name}/controls/K{i}",
-                lambda c, u, m: self.process_message(m.topic, m.payload.decode("utf-8")),
-            )
-
-    def process_message(self, topic: str, payload: str) -> None:
+        self.client.message_callback_add(f"/devices/{self.name}/controls/+", self._on_mqtt)
+
+    def _channel_number(self, color: str) -> int | None:
+        """Return the configured channel number for a color, or None if it is not usable."""
+        channel = self.channels.get(color)
+        if channel is None:
+            return None
+        if type(channel) is not int or not 1 <= channel <= 4:
+            logging.error(f"Invalid channel for color {color} of device {self.name}: {channel!r}")
+            return None
+        return channel
+
+    def _on_mqtt(self, client, userdata, message: mqtt.MQTTMessage) -> None:
+        """Pass a raw MQTT message to process_message."""
+        self.process_message(message.topic, message.payload)
+
+    def process_message(self, topic: str, payload: bytes) -> None:
         """Handle incoming MQTT messages."""
         try:
-            logging.debug(f"Received message: {topic} - {payload}")
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("Received message: %s - %s", topic, payload)
 
-            last_topic = topic.split("/")[-1]
-            if last_topic.startswith("K"):
-                self.state["k_values"][last_topic] = int(payload)
-            elif last_topic.startswith("Channel"):
-                self.state["channel_values"][last_topic] = int(payload)
-            else:
-                logging.warning(f"Unknown topic: {topic}")
+            entry = self._dispatch.get(topic[self._ctrl_prefix_len :])
+            if entry is None:
+                # Other controls of the device are delivered by the wildcard too
                 return
 
+            values, idx = entry
+            if values is self._k:
+                new = 1 if int(payload) > 0 else 0
+                self._k_on_count += new - values[idx]
+                values[idx] = new
+            else:
+                values[idx] = _CH_TO_RGB[max(0, min(1000, int(payload)))]
+
             self._execute_callbacks()
         except Exception as e:
             logging.exception(f"Error processing message {topic}: {e}")
@@ -77,32 +176,34 @@ class RazumdomRGBW(Device):
     @property
     def is_on(self) -> bool:
         """Check if the device is turned on."""
-        return all(value > 0 for value in self.state["k_values"].values())
+        return self._k_on_count == 4
 
     @is_on.setter
     def is_on(self, value: bool) -> None:
         """Turn the device on or off."""
-        state_str = str(int(value))
-        for i in range(1, 5):
-            self.client.publish(f"/devices/{self.name}/controls/K{i}/on", state_str)
+        payload = _ON if value else _OFF
+        for topic in self._k_on_topics:
+            self.client.publish(topic, payload, qos=0, retain=False)
 
     @property
     def rgbw(self) -> list[int]:
         """Get the current RGBW values."""
-        rgbw_values = []
-        for color in ["R", "G", "B", "W"]:
-            channel_num = self.channels.get(color)
-            channel_value = self.state["channel_values"].get(f"Channel {channel_num}", 0)
-            rgbw_values.append(round(channel_value * 255 / 1000))
-        return rgbw_values
+        ch_rgb = self._ch_rgb
+        return [0 if c is None else ch_rgb[c - 1] for c in self._rgbw_order]
 
     @rgbw.setter
     def rgbw(self, values: list[int]) -> None:
         """Set the RGBW values."""
-        for i, color in enumerate(["R", "G", "B", "W"]):
-            channel_num = self.channels.get(color)
-            value = round(values[i] * 1000 / 255)
-            self.client.publish(f"/devices/{self.name}/controls/Channel {channel_num}/on", value)
+        for c, value in zip(self._rgbw_order, values):
+            if c is None:
+                continue
+            value = max(0, min(255, value))
+            if type(value) is int:
+                value = _RGB_TO_CH[value]
+            else:
+                # The table only covers ints and gives exactly this result for them
+                value = round(value * 1000 / 255)
+            self.client.publish(self._channel_on_topics[c], value, qos=0, retain=False)
 
     @property
     def brightness(self) -> int:
@@ -123,14 +224,24 @@ class DeviceManager:
         self._mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         self._mqttc.on_connect = self._on_mqtt_connect
         self._mqttc.on_disconnect = self._on_mqtt_disconnect
+        self._mqttc.message_callback_add("/devices/+/rgbw/set", self._handle_set_any)
         self._mqttc.connect(mqtt_host, mqtt_port, keepalive=60)
 
         # Initialize devices
         self._devices: dict[str, Device] = {}
+        # Last published (is_on, rgbw) state per device, used to skip redundant publishes
+        self._last_pub: dict[str, tuple] = {}
 
     def _on_mqtt_connect(self, client, userdata, flags, reason_code, properties) -> None:
         """Handle MQTT connection event."""
         logging.info("Connected to MQTT broker")
+        sock = self._mqttc.socket()
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        except (AttributeError, OSError) as e:
+            logging.warning(f"Failed to set MQTT socket buffer sizes: {e}")
+
         for device in self._devices.values():
             self._mqttc.subscribe(f"/devices/{device.name}/#")
 
@@ -149,11 +260,6 @@ class DeviceManager:
                 device = RazumdomRGBW(self._mqttc, name, channels)
                 device.add_update_callback(self._on_device_update)
                 self._devices[name] = device
-
-                # Subscribe to set commands
-                self._mqttc.message_callback_add(
-                    f"/devices/{name}/rgbw/set", lambda c, u, m: self._handle_set_command(name, m)
-                )
             else:
                 logging.error(f"Unknown device type: {device_type}")
         except KeyError as e:
@@ -161,10 +267,14 @@ class DeviceManager:
         except Exception as e:
             logging.exception(f"Error adding device: {e}")
 
+    def _handle_set_any(self, client, userdata, message: mqtt.MQTTMessage) -> None:
+        """Route a set command to the device named in its topic."""
+        self._handle_set_command(message.topic.split("/")[2], message)
+
     def _handle_set_command(self, device_name: str, message: mqtt.MQTTMessage) -> None:
         """Handle incoming set commands."""
         try:
-            payload = json.loads(message.payload.decode("utf-8"))
+            payload = _loads(message.payload)
             device = self._devices.get(device_name)
             if not device or not isinstance(device, RazumdomRGBW):
                 return
@@ -196,14 +306,22 @@ class DeviceManager:
     def _on_device_update(self, device: Device) -> None:
         """Handle device updates."""
         if isinstance(device, RazumdomRGBW):
+            rgbw = device.rgbw
+            is_on = device.is_on
+            key = (is_on, tuple(rgbw))
+            if self._last_pub.get(device.name) == key:
+                return
+            self._last_pub[device.name] = key
+
             message = {
-                "state": "ON" if device.is_on else "OFF",
-                "color": dict(zip(["r", "g", "b", "w"], device.rgbw)),
+                "state": "ON" if is_on else "OFF",
+                "color": dict(zip(["r", "g", "b", "w"], rgbw)),
                 "color_mode": "rgbw",
-                "brightness": device.brightness,
+                "brightness": round(sum(rgbw) / 4),
             }
-            logging.debug(f"Publishing state for device {device.name}: {message}")
-            self._mqttc.publish(f"/devices/{device.name}/rgbw", json.dumps(message))
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("Publishing state for device %s: %s", device.name, message)
+            self._mqttc.publish(f"/devices/{device.name}/rgbw", _dumps(message))
         else:
             raise NotImplementedError(f"Update handler for {type(device)} is not implemented")
 